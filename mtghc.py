@@ -1,140 +1,495 @@
 import os
+import atexit
+import json
+import mmap
+import shutil
 import subprocess
-import re
+import shelve
 import tempfile
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import get_all_start_methods, get_context
+from queue import Queue
+from threading import Event, Lock, get_ident, local
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
 
 SCRIPT_FILE_PATTERNS = ['*.py', '*.lua', '*.js', '*.ts', '*.java', '*.rb', '*.php', '*.html', '*.css']
+SUFFIXES = tuple(pattern.lstrip('*') for pattern in SCRIPT_FILE_PATTERNS)
+SKIP_DIRS = frozenset({'.git', 'node_modules', 'vendor', '.venv', '__pycache__'})
 GITHUB_TOKEN = 'token'
 VERBOSE = 0
 USE_SPARSE_CHECKOUT = 0
+USE_PARTIAL_CLONE = 1
+USE_LIBGIT2 = 1
 limit = 0
 max_repos = 0
-file_counter_lock = Lock()
-file_counter = 0
+SEARCH_RESULT_CAP = 1000
+SEARCH_START_DATE = date(2007, 10, 1)
+SEARCH_REQUESTS_PER_MINUTE = 30
+SEARCH_PER_PAGE = 100
+SEARCH_CONCURRENCY = 4
+ETAG_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'mtghc', 'etags.db')
+ETAG_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+ETAG_CACHED_HEADERS = ('ETag', 'Content-Type')
+GRAPHQL_URL = 'https://api.github.com/graphql'
+GRAPHQL_BATCH_SIZE = 100
+CLONE_WORKERS = 16
+MAX_RESIDENT_CLONES = 20
+TMPFS_PATH = '/dev/shm'
+TMPFS_MIN_FREE = 4 * 1024 * 1024 * 1024
+CLONES_DONE = object()
+stop_requested = Event()
+SUBPROCESS_POLL_INTERVAL = 0.5
+MAX_FILE_SIZE = 2 * 1024 * 1024
+BINARY_SNIFF_SIZE = 512
+MMAP_THRESHOLD = 256 * 1024
+SCAN_CHUNKSIZE = 64
+worker_output = local()
+worker_output_handles = []
+SCANNED_BLOBS_MAX = 100_000
+NO_MATCHES = ()
+scanned_blobs = OrderedDict()
+scanned_blobs_lock = Lock()
+
+SESSION = requests.Session()
+SESSION.headers.update({'Authorization': f'token {GITHUB_TOKEN}', 'Accept': 'application/vnd.github+json'})
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[502, 503, 504], raise_on_status=False)))
 
 def print_verbose(message):
     if VERBOSE:
         print(message)
 
 def run_subprocess(command, cwd=None):
-    try:
-        if VERBOSE:
-            subprocess.run(command, cwd=cwd, check=True)
-        else:
-            subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except subprocess.CalledProcessError as e:
-        print_verbose(f"Subprocess error: {e}")
-
-def fetch_repos(query, max_repos):
-    per_page = 100
-    repos = []
-    page = 1
-    while len(repos) < max_repos:
-        url = f'https://api.github.com/search/repositories?q={query}&sort=stars&order=desc&per_page={per_page}&page={page}'
-        print_verbose(f"Fetching page {page} from {url}")
-        response = requests.get(url, headers={'Authorization': f'token {GITHUB_TOKEN}'})
-        if response.status_code == 200:
-            data = response.json()
-            new_repos = data.get('items', [])
-            print_verbose(f"Page {page} fetched, {len(new_repos)} repositories found.")
-            if not new_repos:
-                break  
-            repos.extend(new_repos)
-            page += 1
-            if len(repos) > max_repos:
-                repos = repos[:max_repos]
-        elif response.status_code == 403: # Rate limit code
-            print_verbose(f"Error fetching page {page}: {response.status_code} - {response.text}")
-            print_verbose("Rate limit exceeded. Waiting for 60 seconds before retrying...")
-            time.sleep(60)  
-            continue  
-        else:
+    output = None if VERBOSE else subprocess.DEVNULL
+    # A session of its own keeps Ctrl-C from killing only part of git's process tree, which can
+    # leave the survivors deadlocked; an interrupted run kills the whole command instead.
+    with subprocess.Popen(command, cwd=cwd, stdout=output, stderr=output, start_new_session=True) as process:
+        while True:
+            try:
+                process.wait(timeout=SUBPROCESS_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if stop_requested.is_set():
+                    process.kill()
+    if process.returncode != 0:
+        print_verbose(f"Subprocess error: {subprocess.CalledProcessError(process.returncode, command)}")
+
+class GitHubClient:
+    def __init__(self, session, search_requests_per_minute=SEARCH_REQUESTS_PER_MINUTE, max_concurrency=SEARCH_CONCURRENCY, etag_cache_path=ETAG_CACHE_PATH):
+        self.session = session
+        self.max_concurrency = max_concurrency
+        self.search_times = deque(maxlen=search_requests_per_minute)
+        self.lock = Lock()
+        self.etag_cache = self.open_etag_cache(etag_cache_path) if etag_cache_path else None
+        self.etag_cache_lock = Lock()
+
+    def open_etag_cache(self, path):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            etag_cache = shelve.open(path)
+            # Bisected search URLs embed today's date, so old keys never hit again; drop them
+            # along with entries from older versions that pickled whole responses.
+            expired = time.time() - ETAG_CACHE_MAX_AGE
+            for url in [url for url, entry in etag_cache.items() if not isinstance(entry, dict) or entry.get('stored_at', 0) < expired]:
+                del etag_cache[url]
+        except Exception as e:
+            print_verbose(f"ETag cache unavailable: {e}")
+            return None
+        atexit.register(etag_cache.close)
+        return etag_cache
+
+    def cached_entry(self, url):
+        if self.etag_cache is None:
+            return None
+        with self.etag_cache_lock:
+            return self.etag_cache.get(url)
+
+    def cache_response(self, url, response):
+        if self.etag_cache is None or 'ETag' not in response.headers:
+            return
+        # Only the body and a few headers are kept; the response's request carries the auth token.
+        entry = {
+            'etag': response.headers['ETag'],
+            'status_code': response.status_code,
+            'content': response.content,
+            'headers': {name: response.headers[name] for name in ETAG_CACHED_HEADERS if name in response.headers},
+            'stored_at': time.time(),
+        }
+        with self.etag_cache_lock:
+            self.etag_cache[url] = entry
+
+    def cached_response(self, url, entry):
+        response = requests.Response()
+        response.url = url
+        response.status_code = entry['status_code']
+        response.headers.update(entry['headers'])
+        response.encoding = 'utf-8'
+        response._content = entry['content']
+        return response
+
+    def throttle_search(self):
+        with self.lock:
+            if len(self.search_times) == self.search_times.maxlen:
+                wait = self.search_times[0] + 60 - time.monotonic()
+                if wait > 0:
+                    print_verbose(f"Search rate limit reached. Waiting {wait:.1f} seconds...")
+                    time.sleep(wait)
+            self.search_times.append(time.monotonic())
+
+    def refund_search(self):
+        with self.lock:
+            if self.search_times:
+                self.search_times.pop()
+
+    def wait_for_reset(self, response):
+        reset = int(response.headers.get('X-RateLimit-Reset', time.time() + 60))
+        wait = max(0, reset - time.time()) + 1
+        print_verbose(f"Rate limit exceeded. Waiting {wait:.0f} seconds for reset...")
+        time.sleep(wait)
+
+    def get(self, url, search=False):
+        return self.request('GET', url, search=search)
+
+    def post(self, url, payload):
+        return self.request('POST', url, json=payload)
+
+    def request(self, method, url, search=False, **kwargs):
+        cached = self.cached_entry(url) if method == 'GET' else None
+        headers = {'If-None-Match': cached['etag']} if cached is not None else {}
+        while True:
+            if search:
+                self.throttle_search()
+            print_verbose(f"Fetching {url}")
+            response = self.session.request(method, url, headers=headers, **kwargs)
+            remaining = int(response.headers.get('X-RateLimit-Remaining', 1))
+            if response.status_code in (403, 429) and 'rate limit' in response.text.lower():
+                print_verbose(f"Error fetching {url}: {response.status_code} - {response.text}")
+                self.wait_for_reset(response)
+                continue
+            if remaining == 0:
+                self.wait_for_reset(response)
+            if response.status_code == 304 and cached is not None:
+                # Conditional requests answered with 304 don't count against the rate limit.
+                if search:
+                    self.refund_search()
+                return self.cached_response(url, cached)
+            if method == 'GET' and response.status_code == 200:
+                self.cache_response(url, response)
+            return response
+
+    def get_many(self, urls, search=False):
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            return list(executor.map(lambda url: self.get(url, search=search), urls))
+
+def search_url(query, page):
+    return f'https://api.github.com/search/repositories?q={query}&sort=stars&order=desc&per_page={SEARCH_PER_PAGE}&page={page}'
+
+def fetch_repos_range(client, query, start, end, remaining, seen):
+    if remaining <= 0:
+        return []
+    ranged_query = query if start is None else f'{query} created:{start.isoformat()}..{end.isoformat()}'
+    response = client.get(search_url(ranged_query, 1), search=True)
+    if response.status_code != 200:
+        print_verbose(f"Error fetching page 1: {response.status_code} - {response.text}")
+        return []
+    data = response.json()
+    total_count = data.get('total_count', 0)
+    if total_count > SEARCH_RESULT_CAP and remaining > SEARCH_RESULT_CAP and (start is None or start < end):
+        # The Search API stops at 1000 results, so split the range and search each half.
+        if start is None:
+            start, end = SEARCH_START_DATE, date.today()
+        mid = start + (end - start) // 2
+        print_verbose(f"{total_count} results for {start}..{end}, splitting at {mid}.")
+        repos = fetch_repos_range(client, query, start, mid, remaining, seen)
+        repos += fetch_repos_range(client, query, mid + timedelta(days=1), end, remaining - len(repos), seen)
+        return repos
+    pages = [data.get('items', [])]
+    # Every page is known up front once we have the total, so fetch the rest concurrently.
+    last_page = -(-min(total_count, SEARCH_RESULT_CAP, remaining) // SEARCH_PER_PAGE)
+    responses = client.get_many([search_url(ranged_query, page) for page in range(2, last_page + 1)], search=True)
+    for page, response in enumerate(responses, start=2):
+        if response.status_code != 200:
             print_verbose(f"Error fetching page {page}: {response.status_code} - {response.text}")
             break
+        pages.append(response.json().get('items', []))
+    repos = []
+    for page, new_repos in enumerate(pages, start=1):
+        print_verbose(f"Page {page} fetched, {len(new_repos)} repositories found.")
+        for repo in new_repos:
+            if repo['id'] not in seen:
+                seen.add(repo['id'])
+                repos.append(repo)
+    return repos[:remaining]
+
+def fetch_repos(client, query, max_repos):
+    repos = fetch_repos_range(client, query, None, None, max_repos, set())
     print_verbose(f"Total fetched repositories: {len(repos)} for query '{query}'.")
     return repos
 
-def shallow_clone_repo(repo_url, clone_path):
+def libgit2_clone_repo(repo_url, clone_path):
+    callbacks = pygit2.RemoteCallbacks(credentials=pygit2.UserPass(GITHUB_TOKEN, 'x-oauth-basic'))
+    pygit2.clone_repository(repo_url, clone_path, depth=1, callbacks=callbacks)
+
+def fetch_repo_metadata(client, repos):
+    for offset in range(0, len(repos), GRAPHQL_BATCH_SIZE):
+        batch = repos[offset:offset + GRAPHQL_BATCH_SIZE]
+        fields = ' '.join(
+            f'repo{i}: repository(owner: {json.dumps(repo["owner"]["login"])}, name: {json.dumps(repo["name"])}) '
+            '{ nameWithOwner url defaultBranchRef { name } pushedAt }'
+            for i, repo in enumerate(batch)
+        )
+        response = client.post(GRAPHQL_URL, {'query': f'query {{ rateLimit {{ remaining resetAt }} {fields} }}'})
+        if response.status_code != 200:
+            print_verbose(f"Error fetching metadata: {response.status_code} - {response.text}")
+            break
+        data = response.json().get('data') or {}
+        for i, repo in enumerate(batch):
+            repo['metadata'] = data.get(f'repo{i}')
+        print_verbose(f"Fetched metadata for {len(batch)} repositories.")
+        rate_limit = data.get('rateLimit')
+        if rate_limit and rate_limit['remaining'] == 0 and offset + GRAPHQL_BATCH_SIZE < len(repos):
+            reset = datetime.fromisoformat(rate_limit['resetAt'].replace('Z', '+00:00')).timestamp()
+            wait = max(0, reset - time.time()) + 1
+            print_verbose(f"GraphQL rate limit exhausted. Waiting {wait:.0f} seconds for reset...")
+            time.sleep(wait)
+    return repos
+
+def shallow_clone_repo(repo_url, clone_path, patterns=None):
     print_verbose(f"Shallow cloning repository: {repo_url}")
-    run_subprocess(['git', 'clone', '--depth', '1', repo_url, clone_path])
+    # libgit2 can't do partial clones, so sparse checkouts always go through git to skip unmatched blobs.
+    if USE_LIBGIT2 and pygit2 is not None and not patterns:
+        try:
+            libgit2_clone_repo(repo_url, clone_path)
+            print_verbose(f"Repository shallow cloned to {clone_path}.")
+            return
+        except Exception as e:
+            print_verbose(f"libgit2 clone failed, falling back to git: {e}")
+            shutil.rmtree(clone_path, ignore_errors=True)
+    if not patterns:
+        run_subprocess(['git', 'clone', '--depth', '1', repo_url, clone_path])
+    else:
+        command = ['git', 'clone', '--depth', '1', '--no-checkout', '--sparse']
+        if USE_PARTIAL_CLONE:
+            command.append('--filter=blob:none')
+        run_subprocess(command + [repo_url, clone_path])
+        run_subprocess(['git', '-C', clone_path, 'sparse-checkout', 'set', '--no-cone', *patterns])
+        run_subprocess(['git', '-C', clone_path, 'checkout', 'HEAD'])
     print_verbose(f"Repository shallow cloned to {clone_path}.")
 
-def configure_sparse_checkout(repo_path, patterns): # BROKEN
-    sparse_checkout_file = os.path.join(repo_path, '.git', 'info', 'sparse-checkout')
-    with open(sparse_checkout_file, 'w') as f:
-        for pattern in patterns:
-            f.write(pattern + '\n')
-    run_subprocess(['git', 'config', 'core.sparseCheckout', 'true'], cwd=repo_path)
-    run_subprocess(['git', 'checkout', 'HEAD'], cwd=repo_path)
-
-def analyze_code_content(content, limit):
-    print_verbose("Analyzing code content.")
-    code_lines = content.splitlines()
-    results = check_consecutive_whitespace(code_lines, limit)
+TAB_TO_SPACE = bytes.maketrans(b'\t', b' ')
+
+def analyze_code_content(f, limit):
+    results = check_consecutive_whitespace(f, limit)
     return results
 
 def check_consecutive_whitespace(code_lines, limit):
     excessive_whitespace = []
-    pattern = r'[ \t]{' + str(limit) + r',}'
+    append = excessive_whitespace.append
+    tab_to_space = TAB_TO_SPACE
+    # Tabs become spaces, so a run of `limit` spaces is a run of `limit` spaces or tabs.
+    needle = b' ' * limit
     for i, line in enumerate(code_lines, start=1):
-        consecutive_whitespace = re.findall(pattern, line)
-        if consecutive_whitespace:
-            excessive_whitespace.append((i, line.strip()))
+        if needle in line.translate(tab_to_space):
+            append((i, line.strip().decode('utf-8', errors='replace')))
     return excessive_whitespace
 
+def iter_script_files(path, suffixes=SUFFIXES, skip_dirs=SKIP_DIRS):
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name in skip_dirs:
+                    continue
+                yield from iter_script_files(entry.path, suffixes, skip_dirs)
+            elif entry.is_file(follow_symlinks=False) and entry.name.endswith(suffixes):
+                yield entry.path, entry.stat(follow_symlinks=False).st_size
+
+def iter_mapped_lines(mm):
+    start, end = 0, len(mm)
+    while start < end:
+        newline = mm.find(b'\n', start)
+        if newline == -1:
+            newline = end
+        yield mm[start:newline]
+        start = newline + 1
+
+def scan_file(file_path, limit, size=0):
+    with open(file_path, 'rb') as f:
+        # Same heuristic as git: a NUL byte near the start means the file is binary.
+        if b'\0' in f.read(BINARY_SNIFF_SIZE):
+            return []
+        if size > MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return analyze_code_content(iter_mapped_lines(mm), limit)
+        f.seek(0)
+        return analyze_code_content(f, limit)
+
+def scan_file_task(file_path, size, limit):
+    try:
+        return scan_file(file_path, limit, size), None
+    except OSError as e:
+        return None, str(e)
+
 def create_detected_folder():
     if not os.path.exists('Detected'):
         os.makedirs('Detected')
 
-def log_findings(repo_name, repo_owner, repo_url, file_path, results):
-    global file_counter
-    create_detected_folder()
-    for i, (line_no, code) in enumerate(results, start=1):
-        with file_counter_lock:
-            detected_file = os.path.join('Detected', f'detected_{file_counter}.txt')
-            file_counter += 1
-        with open(detected_file, 'w') as f:
-            f.write(f"Repository: {repo_name}\n")
-            f.write(f"Owner: {repo_owner}\n")
-            f.write(f"Repository URL: {repo_url}\n")
-            f.write(f"File: {file_path}\n")
-            f.write('-' * 40 + '\n')
-            f.write(f"Line {line_no}: {code}\n")
-            f.write('-' * 40 + '\n')
-
-def process_repo(repo_url, repo_name, repo_owner, limit=5):
-    print_verbose(f"Processing repository: {repo_url}")
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        clone_path = os.path.join(tmpdirname, 'repo')
+def get_worker_output():
+    handle = getattr(worker_output, 'handle', None)
+    if handle is None:
+        create_detected_folder()
+        detected_file = os.path.join('Detected', f'worker_{get_ident()}.jsonl')
+        handle = open(detected_file, 'a', encoding='utf-8', buffering=1 << 16)
+        worker_output.handle = handle
+        worker_output_handles.append(handle)
+    return handle
+
+def log_findings(repo_name, repo_owner, repo_url, file_path, results, metadata=None):
+    record = {
+        'repo': repo_name,
+        'owner': repo_owner,
+        'url': repo_url,
+        'file': file_path,
+        'matches': [[line_no, code] for line_no, code in results],
+    }
+    if metadata:
+        record['metadata'] = metadata
+    get_worker_output().write(json.dumps(record) + '\n')
+
+def merge_findings():
+    while worker_output_handles:
+        worker_output_handles.pop().close()
+    worker_files = sorted(name for name in os.listdir('Detected') if name.startswith('worker_') and name.endswith('.jsonl'))
+    with open(os.path.join('Detected', 'findings.jsonl'), 'a', encoding='utf-8') as out:
+        for name in worker_files:
+            worker_file = os.path.join('Detected', name)
+            with open(worker_file, encoding='utf-8') as f:
+                shutil.copyfileobj(f, out)
+            os.remove(worker_file)
+
+def tmpfs_has_room():
+    try:
+        return shutil.disk_usage(TMPFS_PATH).free >= TMPFS_MIN_FREE
+    except OSError:
+        return False
+
+def create_tmp_root():
+    # Clones are short-lived, so keep them in memory when a tmpfs is available and big enough.
+    # The clone queue bounds how many clones exist, not their size, so small tmpfs mounts
+    # (Docker defaults to 64 MB) would fail clones with ENOSPC.
+    tmp_root = tempfile.mkdtemp(prefix='mtghc_', dir=TMPFS_PATH if tmpfs_has_room() else None)
+    atexit.register(shutil.rmtree, tmp_root, ignore_errors=True)
+    return tmp_root
+
+def iter_tree_blobs(tree, path):
+    for entry in tree:
+        entry_path = os.path.join(path, entry.name)
+        if entry.type_str == 'tree':
+            if entry.name not in SKIP_DIRS:
+                yield from iter_tree_blobs(entry, entry_path)
+        elif entry.type_str == 'blob' and entry.name.endswith(SUFFIXES):
+            yield entry_path, entry.id.raw
+
+def list_blob_shas(clone_path):
+    # Sparse clones come from git's partial clone, which libgit2 can't open.
+    if USE_LIBGIT2 and pygit2 is not None and not USE_SPARSE_CHECKOUT:
         try:
-            shallow_clone_repo(repo_url, clone_path)
-            if USE_SPARSE_CHECKOUT:
-                configure_sparse_checkout(clone_path, SCRIPT_FILE_PATTERNS)
-            create_detected_folder()
-            for root, dirs, files in os.walk(clone_path):
-                if '.git' in dirs:
-                    dirs.remove('.git')
-                print_verbose(f"Scanning directory: {root}")
-                for file in files:
-                    if any(file.endswith(pattern.strip('*')) for pattern in SCRIPT_FILE_PATTERNS):
-                        file_path = os.path.join(root, file)
-                        try:
-                            with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-                                content = f.read()
-                                results = analyze_code_content(content, limit)
-                                if results:
-                                    log_findings(repo_name, repo_owner, repo_url, file_path, results)
-                                    print_verbose(f"Issues found in {file_path}. Details logged.")
-                                else:
-                                    print_verbose(f"No issues found in {file_path}.")
-                        except OSError as e:
-                            print_verbose(f"Error reading file {file_path}: {e}")
+            return dict(iter_tree_blobs(pygit2.Repository(clone_path).revparse_single('HEAD').tree, clone_path))
         except Exception as e:
-            print_verbose(f"Error during processing: {e}")
+            print_verbose(f"libgit2 could not list blobs in {clone_path}, falling back to git: {e}")
+    try:
+        output = subprocess.run(['git', '-C', clone_path, 'ls-tree', '-r', '-z', 'HEAD'], check=True, capture_output=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        print_verbose(f"Could not list blobs in {clone_path}: {e}")
+        return {}
+    blob_shas = {}
+    for record in output.split(b'\0'):
+        if record:
+            info, _, path = record.partition(b'\t')
+            blob_shas[os.path.join(clone_path, os.fsdecode(path))] = bytes.fromhex(info.split()[2].decode())
+    return blob_shas
+
+def clone_repo(repo, clone_queue, tmp_root=None):
+    print_verbose(f"Processing repository: {repo['clone_url']}")
+    tmpdirname = tempfile.mkdtemp(dir=tmp_root)
+    clone_path = os.path.join(tmpdirname, 'repo')
+    try:
+        shallow_clone_repo(repo['clone_url'], clone_path, SCRIPT_FILE_PATTERNS if USE_SPARSE_CHECKOUT else None)
+    except Exception as e:
+        print_verbose(f"Error during cloning: {e}")
+        shutil.rmtree(tmpdirname, ignore_errors=True)
+        return
+    if stop_requested.is_set():
+        shutil.rmtree(tmpdirname, ignore_errors=True)
+        return
+    # Blocks while MAX_RESIDENT_CLONES repositories are already waiting to be scanned.
+    clone_queue.put((repo, tmpdirname, clone_path))
+
+def scan_worker(clone_queue, file_pool, limit):
+    while True:
+        item = clone_queue.get()
+        if item is CLONES_DONE:
+            break
+        repo, tmpdirname, clone_path = item
+        try:
+            # After an interrupt, keep draining the queue so blocked clone workers can finish.
+            if not stop_requested.is_set():
+                process_repo(file_pool, clone_path, repo['clone_url'], repo['name'], repo['owner']['login'], limit, repo.get('metadata'))
+        finally:
+            shutil.rmtree(tmpdirname, ignore_errors=True)
+
+def process_repo(file_pool, clone_path, repo_url, repo_name, repo_owner, limit=5, metadata=None):
+    flagged = 0
+    try:
+        create_detected_folder()
+        files = [(file_path, size) for file_path, size in iter_script_files(clone_path) if size <= MAX_FILE_SIZE]
+        blob_shas = list_blob_shas(clone_path)
+        # Identical blobs (vendored libraries, licenses) show up across many repos, so reuse earlier scans.
+        # Paths sharing a SHA within this repo are scanned once and the result fanned out.
+        known, pending, paths_by_sha = [], [], {}
+        with scanned_blobs_lock:
+            for file_path, size in files:
+                sha = blob_shas.get(file_path)
+                results = scanned_blobs.get(sha)
+                if results is not None:
+                    scanned_blobs.move_to_end(sha)
+                    known.append((file_path, results))
+                elif sha in paths_by_sha:
+                    paths_by_sha[sha].append(file_path)
+                else:
+                    if sha is not None:
+                        paths_by_sha[sha] = [file_path]
+                    pending.append((file_path, size))
+        file_paths = [file_path for file_path, _ in pending]
+        sizes = [size for _, size in pending]
+        scans = file_pool.map(scan_file_task, file_paths, sizes, [limit] * len(pending), chunksize=SCAN_CHUNKSIZE)
+        for file_path, (results, error) in zip(file_paths, scans):
+            if error is not None:
+                print_verbose(f"Error reading file {file_path}: {error}")
+                continue
+            sha = blob_shas.get(file_path)
+            if sha is not None:
+                # Bounded LRU keyed by raw 20-byte SHAs; clean blobs share one empty tuple.
+                with scanned_blobs_lock:
+                    scanned_blobs[sha] = results or NO_MATCHES
+                    if len(scanned_blobs) > SCANNED_BLOBS_MAX:
+                        scanned_blobs.popitem(last=False)
+            known.extend((path, results) for path in paths_by_sha.get(sha, [file_path]))
+        for file_path, results in known:
+            if results:
+                flagged += 1
+                log_findings(repo_name, repo_owner, repo_url, file_path, results, metadata)
+        print_verbose(f"Scanned {len(files)} files in {repo_url} ({len(files) - len(pending)} already seen), {flagged} with issues.")
+    except Exception as e:
+        print_verbose(f"Error during processing: {e}")
 
 def get_boolean_input(prompt):
     response = input(prompt).strip().lower()
@@ -150,27 +505,49 @@ def main():
     
     search_query = 'stars:>=0' if query.lower() == 'all' else f'topic:{query}'
     print_verbose(f"Fetching repositories for query: {search_query}")
-    repos = fetch_repos(search_query, max_repos)
-    num_cores = os.cpu_count()
-    max_workers = max(1, num_cores - 1)
-    print_verbose(f"Using {max_workers} worker threads.")
-    
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [
-            executor.submit(
-                process_repo,
-                repo['clone_url'],
-                repo['name'],
-                repo['owner']['login'],
-                limit
-            )
-            for repo in repos
-        ]
-        for future in as_completed(futures):
+    client = GitHubClient(SESSION)
+    repos = fetch_repos(client, search_query, max_repos)
+    fetch_repo_metadata(client, repos)
+    scan_workers = os.cpu_count() or 1
+    print_verbose(f"Using {CLONE_WORKERS} clone threads, {scan_workers} scan threads and {scan_workers} scan processes.")
+
+    tmp_root = create_tmp_root()
+    print_verbose(f"Cloning into {tmp_root}.")
+    try:
+        clone_queue = Queue(maxsize=MAX_RESIDENT_CLONES)
+        # Avoid plain fork in a process that is already running clone and scan threads; Windows only has spawn.
+        start_method = 'forkserver' if 'forkserver' in get_all_start_methods() else 'spawn'
+        file_pool = ProcessPoolExecutor(max_workers=scan_workers, mp_context=get_context(start_method))
+        with file_pool, ThreadPoolExecutor(max_workers=scan_workers) as scan_pool:
+            scan_futures = [scan_pool.submit(scan_worker, clone_queue, file_pool, limit) for _ in range(scan_workers)]
+            clone_pool = ThreadPoolExecutor(max_workers=CLONE_WORKERS)
             try:
-                future.result()
-            except Exception as e:
-                print_verbose(f"Thread error: {e}")
+                clone_futures = [clone_pool.submit(clone_repo, repo, clone_queue, tmp_root) for repo in repos]
+                for future in as_completed(clone_futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print_verbose(f"Thread error: {e}")
+            except BaseException:
+                stop_requested.set()
+                raise
+            finally:
+                # Scan workers block on the queue until they see a sentinel, so always send them,
+                # even when an interrupt or error escapes the clone loop.
+                clone_pool.shutdown(cancel_futures=stop_requested.is_set())
+                for _ in scan_futures:
+                    clone_queue.put(CLONES_DONE)
+            for future in as_completed(scan_futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print_verbose(f"Thread error: {e}")
+    finally:
+        # Clones may live in RAM, so don't leave them for interpreter shutdown.
+        shutil.rmtree(tmp_root, ignore_errors=True)
+    create_detected_folder()
+    merge_findings()
+    print_verbose("Findings written to Detected/findings.jsonl.")
 
 if __name__ == "__main__":
     main()